@@ -1,19 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
+import aiohttp
 import argparse
+import asyncio
+import asyncpg
+import atexit
 import datetime
 import logging
 import logging.handlers
-import requests
+import orjson
+import queue
 import time
-import psycopg2
-import psycopg2.extras
-import json
-import urllib3
 import typing
 
 
+# Naive, as the start column is TIMESTAMP holding UTC
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
 def setup_logger(app_name, stderr_log_lvl):
     """
     Create logger that logs to both stderr and log file but with different log levels
@@ -41,57 +46,91 @@ def setup_logger(app_name, stderr_log_lvl):
     console_handler.setLevel(stderr_log_lvl)
     logging.getLogger().addHandler(console_handler)
 
-    # Add file rotating handler, with level DEBUG
+    # Add file rotating handler, with level DEBUG, writing from a background thread
     rotating_handler = logging.handlers.RotatingFileHandler(
-        filename=f"/tmp/{app_name}.log", maxBytes=100 * 1000, backupCount=2
+        filename=f"/tmp/{app_name}.log", maxBytes=10 * 1024 * 1024, backupCount=2
     )
     rotating_handler.setFormatter(formatter)
     rotating_handler.setLevel(logging.DEBUG)
-    logging.getLogger().addHandler(rotating_handler)
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setLevel(logging.DEBUG)
+    logging.getLogger().addHandler(queue_handler)
+    listener = logging.handlers.QueueListener(log_queue, rotating_handler)
+    listener.start()
+    atexit.register(listener.stop)
 
     return logging.getLogger(app_name)
 
 
+async def abatched(aiterable: typing.AsyncIterable, size: int) -> typing.AsyncGenerator[list, None]:
+    """
+    Groups items from asynchronous iterable into lists of given size, last list might be shorter.
+    """
+    batch = []
+    async for item in aiterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
+
+
 class Worker():
     def __init__(self):
         self.logger = logging.getLogger(str(self.__class__))
 
     def _setup(self, args):
-        # FIXME
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
         self.headers = {
             "Content-Type": "application/json",
+            "Accept-Encoding": "gzip, deflate",
             "X-Horreum-API-Key": args.horreum_api_token,
         }
 
-    def _db_table_init(self, conn):
+        # One session for all Horreum requests, so connections are kept alive and reused
+        self.semaphore = asyncio.Semaphore(args.horreum_concurrency)
+        connector = aiohttp.TCPConnector(
+            limit_per_host=args.horreum_concurrency,
+            keepalive_timeout=30,
+            ssl=False,  # FIXME
+        )
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers)
+
+    async def _db_table_init(self, conn):
         """
-        Checks if a table exists in a PostgreSQL database and creates it if it doesn't.
+        Creates the table and its indexes in a PostgreSQL database if they don't exist yet.
 
         Args:
-            conn: A psycopg2 connection object.
+            conn: An asyncpg connection object.
         """
-        cur = conn.cursor()
-        cur.execute(f"SELECT EXISTS (SELECT FROM pg_tables WHERE tablename = 'data');")
-        table_exists = cur.fetchone()[0]
-
-        if not table_exists:
-            self.logger.info("Table not found in the PostgreSQL, creating it")
-            cur.execute(f"""
-                CREATE TABLE data (
-                    id SERIAL PRIMARY KEY,
-                    horreum_testid INTEGER,
-                    horreum_runid INTEGER,
-                    horreum_datasetid INTEGER,
-                    start TIMESTAMP,
-                    label_values JSONB,
-                    UNIQUE (horreum_testid, horreum_runid, horreum_datasetid)
-                );
-            """)
-            conn.commit()
-
-    def _db_connect(self, args):
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS data (
+                id SERIAL PRIMARY KEY,
+                horreum_testid INTEGER,
+                horreum_runid INTEGER,
+                horreum_datasetid INTEGER,
+                start TIMESTAMP,
+                label_values JSONB,
+                UNIQUE (horreum_testid, horreum_runid, horreum_datasetid)
+            );
+        """)
+        # Allows index-only scans when looking up already stored datasets of a test
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS data_testid_dsid_idx ON data (horreum_testid, horreum_datasetid);")
+
+    async def _db_prepare(self, conn):
+        """
+        Prepares statements executed for every batch, so they are parsed and planned only once per connection.
+
+        Args:
+            conn: An asyncpg connection object.
+        """
+        self.db_existing = await conn.prepare(f"""
+            SELECT horreum_testid, horreum_datasetid FROM data
+            WHERE horreum_testid = ANY($1::INTEGER[]) AND horreum_datasetid = ANY($2::INTEGER[]);
+        """)
+
+    async def _db_connect(self, args):
         """
         Connects to a PostgreSQL database.
 
@@ -99,55 +138,103 @@ class Worker():
             args: Argparse namespace with PostgreSQL connection info.
 
         Returns:
-            A psycopg2 connection object
+            An asyncpg connection object
         """
         db_params = {
-            "dbname": args.postgresql_db,
+            "database": args.postgresql_db,
             "user": args.postgresql_user,
             "password": args.postgresql_pass,
             "host": args.postgresql_host,
             "port": args.postgresql_port,
         }
-        conn = psycopg2.connect(**db_params)
-        self.logger.debug(f"Connected to the PostgreSQL host {db_params['host']}")
+        # Outside of explicit transactions every statement commits on its own
+        conn = await asyncpg.connect(**db_params)
+        self.logger.debug("Connected to the PostgreSQL host %s", db_params["host"])
         return conn
 
-    def _db_insert(self, conn, data_list):
+    async def _db_known_datasets(self, conn, test_id: int) -> set[int]:
         """
-        Inserts a batch of data into the specified table, ignoring duplicate rows based on
-        horreum_testid, horreum_runid, and horreum_datasetid.
+        Loads IDs of datasets of a given test that are already stored in the PostgreSQL.
 
         Args:
-            conn: A psycopg2 connection object.
-            data_list: A list of dictionaries, where each dictionary represents a row of data.
+            conn: An asyncpg connection object.
+            test_id (int): The ID of the test in Horreum.
+
+        Returns:
+            set: IDs of datasets already present in the table.
+        """
+        records = await conn.fetch(f"SELECT horreum_datasetid FROM data WHERE horreum_testid = $1;", test_id)
+        known = {i[0] for i in records}
+        self.logger.debug("Found %d datasets of test %d already in PostgreSQL", len(known), test_id)
+        return known
+
+    async def _db_insert(self, conn, data_list):
         """
-        cur = conn.cursor()
+        Inserts a batch of data into the specified table, skipping datasets which are already
+        there. Remaining rows are bulk loaded with binary COPY.
 
-        query = f"""
-            INSERT INTO data (horreum_testid, horreum_runid, horreum_datasetid, start, label_values)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (horreum_testid, horreum_runid, horreum_datasetid) DO NOTHING;
+        Args:
+            conn: An asyncpg connection object.
+            data_list: A list of dictionaries, where each dictionary represents a row of data.
         """
+        records = await self.db_existing.fetch(
+            list({i["horreum_testid"] for i in data_list}),
+            list({i["horreum_datasetid"] for i in data_list}),
+        )
+        existing = {tuple(i) for i in records}
 
-        values_list = []
-        for i in data_list:
-            values = (
+        # Keyed by (test, dataset) to also drop duplicates within the batch
+        rows = {(i["horreum_testid"], i["horreum_datasetid"]): i for i in data_list}
+        values_list = [
+            (
                 i["horreum_testid"],
                 i["horreum_runid"],
                 i["horreum_datasetid"],
                 i["start"],
-                json.dumps(i["label_values"]),
+                orjson.dumps(i["label_values"]).decode("utf-8"),
             )
-            values_list.append(values)
+            for key, i in rows.items() if key not in existing
+        ]
+
+        # Unique constraint on the table still guards against concurrent writers
+        await conn.copy_records_to_table(
+            "data",
+            records=values_list,
+            columns=["horreum_testid", "horreum_runid", "horreum_datasetid", "start", "label_values"],
+        )
+
+        self.logger.debug("Inserted %d rows into PostgreSQL (%d duplicates skipped)", len(values_list), len(data_list) - len(values_list))
+
+    async def _horreum_datasets_page(self, base_url: str, test_id: int, page: int, limit: int) -> list[dict]:
+        """
+        Retrieves one page of datasets from the Horreum API for a given test ID.
+
+        Args:
+            base_url (str): The base URL of the Horreum.
+            test_id (int): The ID of the test for which to retrieve datasets.
+            page (int): The page number to retrieve.
+            limit (int): The number of datasets to retrieve per page.
 
-        psycopg2.extras.execute_batch(cur, query, values_list)
+        Returns:
+            list: A list of dictionaries representing datasets from the Horreum API.
+        """
+        params = {
+            "page": page,
+            "limit": limit,
+            "sort": "start",
+            "direction": "Descending",
+        }
 
-        conn.commit()
-        self.logger.debug(f"Inserted {len(data_list)} rows into PostgreSQL (duplicates ignored)")
+        data = await self._horreum_get(f"{base_url}/api/dataset/list/{test_id}", params=params)
 
-    def _horreum_datasets(self, base_url: str, test_id: int, count: int, page: int, limit: int) -> typing.Generator[dict, None, None]:
+        datasets = data.get("datasets", [])
+        self.logger.debug("Loaded page %d of datasets for test %d with limit %d", page, test_id, limit)
+        return datasets
+
+    async def _horreum_datasets(self, base_url: str, test_id: int, count: int, page: int, limit: int) -> typing.AsyncGenerator[dict, None]:
         """
         Retrieves datasets from the Horreum API for a given test ID, handling pagination, acts as a generator.
+        Next page is prefetched while the current one is being consumed.
 
         Args:
             base_url (str): The base URL of the Horreum.
@@ -160,41 +247,61 @@ class Worker():
             dict: A dictionary representing a dataset from the Horreum API.
         """
         counter = 0
-        while True:
-            params = {
-                "page": page,
-                "limit": limit,
-                "sort": "start",
-                "direction": "Descending",
-            }
-
-            response = requests.get(
-                f"{base_url}/api/dataset/list/{test_id}",
-                headers=self.headers,
-                params=params,
-                verify=False,
-            )
-            response.raise_for_status()
+        next_task = asyncio.create_task(self._horreum_datasets_page(base_url, test_id, page, limit))
+        try:
+            while True:
+                datasets = await next_task
+                next_task = None
+
+                if len(datasets) == 0:
+                    self.logger.debug("Reached end of datasets for test %d on page %d with limit %d", test_id, page, limit)
+                    return
 
-            datasets = response.json().get("datasets", [])
-            self.logger.debug(f"Loaded page {page} of datasets for test {test_id} with limit {limit}")
+                if counter + len(datasets) < count:
+                    next_task = asyncio.create_task(self._horreum_datasets_page(base_url, test_id, page + 1, limit))
 
-            for ds in datasets:
-                yield ds
+                for ds in datasets:
+                    yield ds
 
-                counter += 1
+                    counter += 1
 
-                if counter >= count:
-                    self.logger.debug(f"No more datasets is needed for test {test_id}")
-                    return
+                    if counter >= count:
+                        self.logger.debug("No more datasets is needed for test %d", test_id)
+                        return
 
-            if len(datasets) == 0:
-                self.logger.debug(f"Reached end of datasets for test {test_id} on page {page} with limit {limit}")
-                return
+                page += 1
+        finally:
+            if next_task is not None:
+                next_task.cancel()
 
-            page += 1
+    async def _horreum_get(self, url: str, params: dict | None = None, retries: int = 5) -> typing.Any:
+        """
+        Performs GET request against the Horreum API, retrying with exponential backoff on transient errors.
 
-    def _horreum_labelvalues(self, base_url: str, dataset_id: int) -> dict[str, str]:
+        Args:
+            url (str): The URL to request.
+            params (dict): Optional query parameters.
+            retries (int): How many times to try before giving up.
+
+        Returns:
+            Any: Decoded JSON response.
+        """
+        for attempt in range(retries):
+            try:
+                async with self.semaphore:
+                    async with self.session.get(url, params=params) as response:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status not in (429, 502, 503, 504):
+                    raise
+                if attempt + 1 >= retries:
+                    raise
+                delay = 0.5 * 2 ** attempt
+                self.logger.warning("Request to %s failed (%s), retrying in %s seconds", url, e, delay)
+                await asyncio.sleep(delay)
+
+    async def _horreum_labelvalues(self, base_url: str, dataset_id: int) -> dict[str, str]:
         """
         Retrieves label values for a given dataset ID from the Horreum API.
 
@@ -205,51 +312,89 @@ class Worker():
         Returns:
             dict: A dictionary containing label names as keys and label values as values.
         """
-        response = requests.get(
-            f"{base_url}/api/dataset/{dataset_id}/labelValues",
-            headers=self.headers,
-            verify=False,
-        )
-        response.raise_for_status()
-
-        return {i["name"]: i["value"] for i in response.json()}
+        data = await self._horreum_get(f"{base_url}/api/dataset/{dataset_id}/labelValues")
 
-    def upload(self, args):
-        self._setup(args)
+        return {i["name"]: i["value"] for i in data}
 
-        db_conn = self._db_connect(args)
-        self._db_table_init(db_conn)
+    async def _horreum_rows(self, args, known: set[int], rows: asyncio.Queue):
+        """
+        Collects label values of new datasets from the Horreum API and puts rows for PostgreSQL to the queue.
+        None is put to the queue when done.
 
+        Args:
+            args: Argparse namespace with Horreum connection info.
+            known (set): IDs of datasets already present in the PostgreSQL.
+            rows (asyncio.Queue): Queue to put rows to.
+        """
         datasets_generator = self._horreum_datasets(args.horreum_base_url, args.horreum_test_id, args.horreum_count, args.horreum_page, args.horreum_limit)
-        data_to_insert = []
 
-        for ds in datasets_generator:
-            label_values = self._horreum_labelvalues(args.horreum_base_url, ds["id"])
+        # No need to fetch label values for datasets we already have
+        new_datasets = (ds async for ds in datasets_generator if ds["id"] not in known)
 
-            when = datetime.datetime.fromtimestamp(ds["start"] / 1000, datetime.UTC)
+        # Label values are fetched concurrently for chunks of datasets
+        async for chunk in abatched(new_datasets, args.horreum_concurrency):
+            results = await asyncio.gather(*(self._horreum_labelvalues(args.horreum_base_url, ds["id"]) for ds in chunk))
 
-            if label_values == {}:
-                self.logger.info(f"No labels for dataset {ds['id']} from {when}, skipping it")
-                continue
+            for ds, label_values in zip(chunk, results):
+                when = EPOCH + datetime.timedelta(milliseconds=ds["start"])
 
-            self.logger.debug(f"Collected {len(label_values)} labels for dataset {ds['id']} from {when}")
+                if label_values == {}:
+                    self.logger.info("No labels for dataset %d from %s, skipping it", ds["id"], when)
+                    continue
 
-            data_to_insert.append({
-                "horreum_testid": ds["testId"],
-                "horreum_runid": ds["runId"],
-                "horreum_datasetid": ds["id"],
-                "start": when,
-                "label_values": label_values,
-            })
+                self.logger.debug("Collected %d labels for dataset %d from %s", len(label_values), ds["id"], when)
 
-            if len(data_to_insert) >= 10:
-                self._db_insert(db_conn, data_to_insert)
-                data_to_insert = []
+                await rows.put({
+                    "horreum_testid": ds["testId"],
+                    "horreum_runid": ds["runId"],
+                    "horreum_datasetid": ds["id"],
+                    "start": when,
+                    "label_values": label_values,
+                })
 
-        if len(data_to_insert) > 0:
-            self._db_insert(db_conn, data_to_insert)
+        await rows.put(None)
 
-        db_conn.close()
+    async def _db_writer(self, conn, rows: asyncio.Queue, batch_size: int):
+        """
+        Takes rows from the queue and inserts them into the PostgreSQL in batches, until None is received.
+
+        Args:
+            conn: An asyncpg connection object.
+            rows (asyncio.Queue): Queue to take rows from.
+            batch_size (int): Maximal number of rows to insert at once.
+        """
+        while True:
+            data_to_insert = [await rows.get()]
+            while len(data_to_insert) < batch_size and not rows.empty():
+                data_to_insert.append(rows.get_nowait())
+
+            done = data_to_insert[-1] is None
+            if done:
+                data_to_insert.pop()
+
+            if len(data_to_insert) > 0:
+                await self._db_insert(conn, data_to_insert)
+
+            if done:
+                return
+
+    async def upload(self, args):
+        self._setup(args)
+
+        db_conn = await self._db_connect(args)
+        await self._db_table_init(db_conn)
+        await self._db_prepare(db_conn)
+        known = await self._db_known_datasets(db_conn, args.horreum_test_id)
+
+        # Fetching from Horreum and inserting to PostgreSQL run side by side, connected by the queue
+        rows = asyncio.Queue(maxsize=4 * args.postgresql_batch_size)
+        async with self.session:
+            await asyncio.gather(
+                self._horreum_rows(args, known, rows),
+                self._db_writer(db_conn, rows, args.postgresql_batch_size),
+            )
+
+        await db_conn.close()
 
     def set_args(self, parser, subparsers):
         parser.add_argument(
@@ -319,6 +464,18 @@ class Worker():
             default=1,
             help="From what page of datasets to start",
         )
+        parser_upload.add_argument(
+            "--horreum-concurrency",
+            type=int,
+            default=64,
+            help="How many label values requests to run in parallel",
+        )
+        parser_upload.add_argument(
+            "--postgresql-batch-size",
+            type=int,
+            default=1000,
+            help="How many rows to insert to PostgreSQL at once at most",
+        )
 
 ### Params of the script
 # --horreum-base-url
@@ -382,9 +539,9 @@ def main():
     else:
         logger = setup_logger(logger_name, logging.WARNING)
 
-    logger.debug(f"Args: {args}")
+    logger.debug("Args: %s", args)
 
-    worker.upload(args)
+    asyncio.run(worker.upload(args))
 
 
 if __name__ == "__main__":